@@ -3,24 +3,32 @@
 This is a wrapper around the openssh binaries ssh and scp.
 """
 import io
-import re
 import os
 import os.path
-import sys
-import pipes
-import signal
+import stat
 import shutil
+import string
 import getpass
+import warnings
 import tempfile
 import subprocess
+import concurrent.futures
 
-__all__ = 'SSHConnection SSHForwardingTunnel SSHRevForwardingTunnel SSHResult SSHError b u b_list u_list'.split()
+__all__ = 'SSHConnection SSHForwardingTunnel SSHRevForwardingTunnel SSHResult SSHError b u b_list u_list b_quote'.split()
 
-if sys.version[0] == '2':
-    text = unicode
-    bytes = str
-else:  # PY3K
-    text = str
+#: how long an automatically started shared connection stays open when idle
+CONTROL_PERSIST = '60s'
+
+#: size of the chunks file-like objects are copied in before being sent by scp
+COPY_BUFSIZE = 1024 * 1024
+
+# characters allowed in server names and user logins
+_IDENT_CHARS = (string.ascii_letters + string.digits + '.-_').encode('ascii')
+
+# characters which don't need to be quoted in a shell argument
+_SAFE_CHARS = (string.ascii_letters + string.digits + '@%+=:,./-_').encode('ascii')
+
+text = str
 
 
 def b(string):
@@ -44,15 +52,49 @@ def u(string):
 def b_list(items):
     """
     convert all items of the list to binary representation
+
+    A list which already consists of binary strings only is returned as is.
     """
-    return [b(item) for item in items]
+    if type(items) is list and all(type(item) is bytes for item in items):
+        return items
+    # conversion is inlined: these helpers are called for every argument of
+    # every command line, so the extra function call per item adds up
+    return [item if isinstance(item, bytes) else item.encode('utf-8')
+            for item in items]
 
 
 def u_list(items):
     """
     convert all items of the list to textual representation
+
+    A list which already consists of textual strings only is returned as is.
+    """
+    if type(items) is list and all(type(item) is text for item in items):
+        return items
+    return [item if isinstance(item, text) else item.decode('utf-8')
+            for item in items]
+
+
+def _is_identifier(name):
+    """
+    Check that the name is not empty and consists of latin letters, digits,
+    dots, dashes and underscores only
     """
-    return [u(item) for item in items]
+    try:
+        name = name.encode('ascii')
+    except UnicodeEncodeError:
+        return False
+    # deleting all allowed characters must leave nothing behind
+    return bool(name) and not name.translate(None, _IDENT_CHARS)
+
+
+def _quote_one(chunk):
+    """
+    Quote a single binary string to be safely used as a shell argument
+    """
+    if chunk and not chunk.translate(None, _SAFE_CHARS):
+        return chunk
+    return b"'" + chunk.replace(b"'", b"'\"'\"'") + b"'"
 
 
 def b_quote(cmd_chunks):
@@ -60,14 +102,14 @@ def b_quote(cmd_chunks):
     Given a list of commands (unicode or text strings), return the safe list,
     suitable to be passed to subprocess
     """
-    quoted = []
-    for chunk in cmd_chunks:
-        # pipes.quote works with text representation only
-        quoted.append(b(pipes.quote(u(chunk))))
-    return b(' ').join(quoted)
+    return b' '.join([
+        _quote_one(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+        for chunk in cmd_chunks])
 
 class _SSHTunnel(object):
 
+    __slots__ = ('local_addr', 'local_port', 'remote_addr', 'remote_port')
+
     def __init__(self, local_addr='localhost', local_port=0, remote_addr='localhost', remote_port=0):
         """
         Set up an SSHTunnel object.
@@ -89,10 +131,18 @@ class _SSHTunnel(object):
         """
         Generate the tunnel string portion required in the SSH command line.
         """
-        return ('{l_a}:{l_p}:{r_a}:{r_p}'.format(l_a=self.local_addr, l_p=self.local_port, r_a=self.remote_addr, r_p=self.remote_port))
+        return '%s:%s:%s:%s' % (self.local_addr, self.local_port, self.remote_addr, self.remote_port)
+
+    def __bytes__(self):
+        """
+        Generate the binary representation of the tunnel option for the SSH command.
+        """
+        return b(self.__str__())
 
 class SSHForwardingTunnel(_SSHTunnel):
 
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         """
         Set up a port forwarding (openssh -L) tunnel.
@@ -108,10 +158,12 @@ class SSHForwardingTunnel(_SSHTunnel):
         """
         Generate a forwarding tunnel option command line string for the SSH command.
         """
-        return '-L {tunnel}'.format(tunnel=_SSHTunnel.__str__(self))
+        return '-L %s:%s:%s:%s' % (self.local_addr, self.local_port, self.remote_addr, self.remote_port)
 
 class SSHRevForwardingTunnel(_SSHTunnel):
 
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         """
         Set up a reverse port forwarding (openssh -R) tunnel.
@@ -127,7 +179,7 @@ class SSHRevForwardingTunnel(_SSHTunnel):
         """
         Generate a reverse forwarding tunnel option command line string for the SSH command.
         """
-        return '-R {tunnel}'.format(tunnel=_SSHTunnel.__str__(self))
+        return '-R %s:%s:%s:%s' % (self.local_addr, self.local_port, self.remote_addr, self.remote_port)
 
 
 class SSHConnection(object):
@@ -136,10 +188,18 @@ class SSHConnection(object):
     It provides methods for command execution and file transfer via scp.
     """
 
+    __slots__ = ('server', 'port', 'timeout', 'user', 'debug',
+                 'master', 'slave', 'control_path', 'multiplex', '_control_dir',
+                 'configfile', 'login', 'identity_file', 'ssh_agent_socket',
+                 'options', 'tunneling_pipes', 'master_ssh_pipe',
+                 '_ssh_prefix', '_ssh_options', '_ssh_suffix', '_scp_prefix',
+                 '_env', '_closed', '__weakref__')
+
     def __init__(self, server, login=None, port=None, configfile=None,
                  identity_file=None, ssh_agent_socket=None, timeout=60, debug=False,
                  options=[],
-                 master=False, slave=False, control_path=None):
+                 master=False, slave=False, control_path=None,
+                 multiplex=True):
         """
         Create new object to establish SSH connection to remote servers
 
@@ -157,6 +217,11 @@ class SSHConnection(object):
             established SSHConnection running in master mode)
         :param control_path: a path containing an existing directory and a socket file
             name to be used as the master/slave connection's control path
+        :param multiplex: if neither master nor slave mode is requested, let
+            openssh share one connection between all subsequent ssh and scp
+            calls (ControlMaster=auto). The control socket is created in a
+            private temporary directory unless control_path is given.
+            Ignored in debug mode.
 
         if you want to use it. ``SSH_AUTH_SOCK`` environment variable is
         used if None is supplied.
@@ -171,11 +236,16 @@ class SSHConnection(object):
         .. note:: `man ssh_config` is highly recommended amendment to this
                    command.
         """
+        # resources to be released by close()
+        self._closed = False
+        self.tunneling_pipes = []
+        self._control_dir = None
+
         self.server = server
         self.port = port
         self.timeout = timeout
         self.check_server(server)
-        self.user = getpass.getuser()
+        self.user = _current_user()
         self.debug = debug
 
         # master / slave connections
@@ -185,6 +255,18 @@ class SSHConnection(object):
 
         self.check_master_slave_settings()
 
+        # automatic connection sharing (only if master / slave mode is not used)
+        # with debug output a backgrounded master keeps stderr of the first
+        # ssh process open, so communicate() would wait for it to go away
+        self.multiplex = multiplex and not master and not slave and not debug
+        if self.multiplex and not self.control_path:
+            self._control_dir = tempfile.mkdtemp(prefix='openssh-wrapper-')
+            # the directory belongs to this connection only, so a short fixed
+            # name keeps the socket path below the unix socket length limit
+            self.control_path = os.path.join(self._control_dir, 'control')
+        elif self.multiplex and not os.path.isdir(os.path.dirname(self.control_path)):
+            raise SSHError('SSHConnection expects that a directory for the control_path file already exists.')
+
         if configfile:
             self.configfile = os.path.expanduser(configfile)
             if not os.path.isfile(self.configfile):
@@ -197,8 +279,6 @@ class SSHConnection(object):
         self.ssh_agent_socket = None
         self.options = options
 
-        self.tunneling_pipes = []
-
         if not slave:
 
             # this is only needed for master sessions or for session not in master/slave mode
@@ -212,30 +292,82 @@ class SSHConnection(object):
                     raise SSHError('Key file %s is not found' % self.identity_file)
             self.ssh_agent_socket = ssh_agent_socket
 
+        self.prepare_commands()
+
+        # the environment of ssh processes is taken as of connection creation
+        self._env = dict(os.environ)
+        if self.ssh_agent_socket:
+            self._env['SSH_AUTH_SOCK'] = self.ssh_agent_socket
+
         if self.master:
             init_master_ssh_command = self.ssh_command(init_master=True)
 
             self.master_ssh_pipe = subprocess.Popen(init_master_ssh_command,
-                                                stdin=None,
-                                                stdout=None,
-                                                stderr=None,
-                                                env=self.get_env())
+                                                stdin=subprocess.DEVNULL,
+                                                stdout=subprocess.DEVNULL,
+                                                stderr=subprocess.DEVNULL,
+                                                env=self._env)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def __del__(self):
         """
         SSHConnection destructor method
+
+        Only a safety net: call :func:`close()` (or use the connection as a
+        context manager) to release the ssh processes deterministically.
+        """
+        if getattr(self, '_closed', True):
+            return
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """
+        Take down all SSH forwarding tunnels, the SSH master process (in
+        master mode) and the shared connection which has been started
+        automatically (see the ``multiplex`` option).
+
+        The connection is not supposed to be used after it has been closed.
         """
+        if self._closed:
+            return
+        self._closed = True
+
         # take down all SSH forwarding tunnels
         for tunneling_pipe in self.tunneling_pipes:
-            # empty the stdout, stderr bufffer of the subprocess PIPE
-            tunneling_pipe.terminate()
-            tunneling_pipe.communicate()
+            _terminate(tunneling_pipe)
+        self.tunneling_pipes = []
 
-        if self.master:
-            # take down SSH master process...
-            if hasattr(self, 'master_ssh_pipe') and self.master_ssh_pipe:
-                self.master_ssh_pipe.terminate()
-                self.master_ssh_pipe.communicate()
+        # take down SSH master process...
+        master_ssh_pipe = getattr(self, 'master_ssh_pipe', None)
+        if master_ssh_pipe:
+            _terminate(master_ssh_pipe)
+
+        # ...and the shared connection (no need to bother ssh if the master
+        # has never been started)
+        if self.multiplex and os.path.exists(self.control_path):
+            control_command = self.control_command('exit')
+            try:
+                pipe = subprocess.Popen(control_command,
+                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE, env=self._env)
+                self.communicate(pipe, control_command)
+            except (SSHError, OSError):
+                # close() may run on the way out of a failing with block,
+                # don't shadow that error; an orphaned master goes away by
+                # itself after CONTROL_PERSIST anyway
+                pass
+
+        if self._control_dir:
+            shutil.rmtree(self._control_dir, ignore_errors=True)
+            self._control_dir = None
 
     def check_server(self, server):
         """
@@ -245,7 +377,7 @@ class SSHConnection(object):
         :return: None
         :raise: SSHError
         """
-        if not re.compile(r'^[a-zA-Z0-9.\-_]+$').match(server):
+        if not _is_identifier(server):
             raise SSHError('Server name contains illegal symbols')
 
     def check_login(self, login):
@@ -256,7 +388,7 @@ class SSHConnection(object):
         :return: None
         :raise: SSHError
         """
-        if not re.compile(r'^[a-zA-Z0-9.\-_]+$').match(login):
+        if not _is_identifier(login):
             raise SSHError('User login contains illegal symbols')
 
     def check_master_slave_settings(self):
@@ -311,24 +443,8 @@ class SSHConnection(object):
         ssh_command = self.ssh_command(interpreter=interpreter, forward_ssh_agent=forward_ssh_agent, tunnels=[])
         pipe = subprocess.Popen(ssh_command,
                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE, env=self.get_env())
-        try:
-            signal.signal(signal.SIGALRM, _timeout_handler)
-        except ValueError:  # signal only works in main thread
-            pass
-        signal.alarm(self.timeout)
-        out = b('')
-        err = b('')
-        try:
-            out, err = pipe.communicate(b(command))
-        except IOError as exc:
-            # pipe.terminate() # only in python 2.6 allowed
-            os.kill(pipe.pid, signal.SIGTERM)
-            signal.alarm(0)  # disable alarm
-            raise SSHError("%s (under %s): %s" % (
-                ' '.join(u_list(ssh_command)), self.user, str(exc)))
-
-        signal.alarm(0)  # disable alarm
+                stderr=subprocess.PIPE, env=self._env)
+        out, err = self.communicate(pipe, ssh_command, b(command))
         returncode = pipe.returncode
         if returncode == 255:  # ssh client error
             raise SSHError("%s (under %s): %s" % (
@@ -336,6 +452,40 @@ class SSHConnection(object):
         return SSHResult(command, out.strip(), err.strip(), returncode)
 
 
+    def run_many(self, commands, interpreter='/bin/bash', forward_ssh_agent=False,
+                 max_concurrency=8):
+        """
+        Execute several commands concurrently, each one as with :func:`run()`.
+
+        With connection sharing (see the ``multiplex`` option, or slave mode)
+        every command only opens a new session on the already established
+        connection, so running them in parallel is cheap. The first command
+        is run alone to let it start the shared connection.
+
+        :param commands: list of commands to execute
+        :param interpreter: name of the interpreter (by default "/bin/bash" is used)
+        :param forward_ssh_agent: turn this flag to `True`, if you want to use
+        and forward SSH agent
+        :param max_concurrency: maximum number of commands executed at the
+        same time. Keep it below the MaxSessions setting of the server
+        (10 by default).
+        :return: list of SSH result instances in the order of commands
+        :rtype: list of SSHResult
+
+        :raise: SSHError, if server is unreachable, or timeout has reached.
+        """
+        def run(command):
+            return self.run(command, interpreter=interpreter,
+                            forward_ssh_agent=forward_ssh_agent)
+
+        commands = list(commands)
+        if not commands:
+            return []
+        results = [run(commands[0])]
+        with concurrent.futures.ThreadPoolExecutor(max_concurrency) as executor:
+            results += executor.map(run, commands[1:])
+        return results
+
     def run_tunnels(self, tunnels):
         """
 
@@ -355,11 +505,13 @@ class SSHConnection(object):
 
         ssh_command = self.ssh_command(tunnels=tunnels)
 
+        # nobody reads the output of the tunneling process, so don't attach
+        # pipes to it: once their buffers are full, ssh would block on them
         tunneling_pipe = subprocess.Popen(ssh_command,
-                                          stdin=subprocess.PIPE,
-                                          stdout=subprocess.PIPE,
-                                          stderr=subprocess.PIPE,
-                                          env=self.get_env())
+                                          stdin=subprocess.DEVNULL,
+                                          stdout=subprocess.DEVNULL,
+                                          stderr=subprocess.DEVNULL,
+                                          env=self._env)
 
         # collect the tunneling pipes...
         self.tunneling_pipes.append(tunneling_pipe)
@@ -407,45 +559,33 @@ class SSHConnection(object):
         scp_command = self.scp_command(filenames, target)
         pipe = subprocess.Popen(scp_command,
                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE, env=self.get_env())
-        try:
-            signal.signal(signal.SIGALRM, _timeout_handler)
-        except ValueError:  # signal only works in main thread
-            pass
-        signal.alarm(self.timeout)
-        err = b('')
+                stderr=subprocess.PIPE, env=self._env)
         try:
-            _, err = pipe.communicate()
-        except IOError as exc:
-            # pipe.terminate() # only in python 2.6 allowed
-            os.kill(pipe.pid, signal.SIGTERM)
-            signal.alarm(0)  # disable alarm
+            _, err = self.communicate(pipe, scp_command)
+        except SSHError:
             cleanup_tmp_dir()
-            raise SSHError("%s (under %s): %s" % (
-                ' '.join(u_list(scp_command)), self.user, str(exc)))
-        signal.alarm(0)  # disable alarm
+            raise
         returncode = pipe.returncode
         if returncode != 0:  # ssh client error
             cleanup_tmp_dir()
             raise SSHError("%s (under %s): %s" % (
                 ' '.join(u_list(scp_command)), self.user, err.strip()))
 
-        if mode or owner:
-            targets = self.get_scp_targets(filenames, target)
-            if mode:
-                cmd_chunks = ['chmod', mode] + targets
-                cmd = b_quote(cmd_chunks)
-                result = self.run(cmd)
-                if result.returncode:
-                    cleanup_tmp_dir()
-                    raise SSHError("change mode: %s" % result.stderr.strip())
-            if owner:
-                cmd_chunks = ['chown', owner] + targets
-                cmd = b_quote(cmd_chunks)
-                result = self.run(cmd)
-                if result.returncode:
-                    cleanup_tmp_dir()
-                    raise SSHError("change owner: %s" % result.stderr.strip())
+        # mode and owner are changed by a single remote command
+        commands, actions = [], []
+        if mode:
+            commands.append(['chmod', mode])
+            actions.append('mode')
+        if owner:
+            commands.append(['chown', owner])
+            actions.append('owner')
+        if commands:
+            cmd = self.scp_targets_command(commands, filenames, target)
+            result = self.run(cmd)
+            if result.returncode:
+                cleanup_tmp_dir()
+                raise SSHError("change %s: %s" % (
+                    ' and '.join(actions), result.stderr.strip()))
         cleanup_tmp_dir()
 
     def scp_down(self, remotefile, localtarget, mode=None, owner=None):
@@ -471,45 +611,38 @@ class SSHConnection(object):
         if scp_command:
             pipe = subprocess.Popen(scp_command,
                     stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE, env=self.get_env())
-            try:
-                signal.signal(signal.SIGALRM, _timeout_handler)
-            except ValueError:  # signal only works in main thread
-                pass
-            signal.alarm(self.timeout)
-            err = b('')
-            try:
-                _, err = pipe.communicate()
-            except IOError as exc:
-                # pipe.terminate() # only in python 2.6 allowed
-                os.kill(pipe.pid, signal.SIGTERM)
-                signal.alarm(0)  # disable alarm
-                cleanup_tmp_dir()
-                raise SSHError("%s (under %s): %s" % (
-                    ' '.join(scp_command), self.user, str(exc)))
-            signal.alarm(0)  # disable alarm
+                    stderr=subprocess.PIPE, env=self._env)
+            _, err = self.communicate(pipe, scp_command)
             returncode = pipe.returncode
             if returncode != 0:  # ssh client error
-                cleanup_tmp_dir()
                 raise SSHError("%s (under %s): %s" % (
-                    ' '.join(scp_command), self.user, err.strip()))
+                    ' '.join(u_list(scp_command)), self.user, err.strip()))
 
             if mode or owner:
-                targets = self.get_scp_targets(filenames, target)
-                if mode:
-                    cmd_chunks = ['chmod', mode] + targets
-                    cmd = b_quote(cmd_chunks)
-                    result = self.run(cmd)
-                    if result.returncode:
-                        cleanup_tmp_dir()
-                        raise SSHError("change mode: %s" % result.stderr.strip())
-                if owner:
-                    cmd_chunks = ['chown', owner] + targets
-                    cmd = b_quote(cmd_chunks)
-                    result = self.run(cmd)
-                    if result.returncode:
-                        cleanup_tmp_dir()
-                        raise SSHError("change owner: %s" % result.stderr.strip())
+                # the downloaded file is a local one, so fix it up locally
+                if os.path.isdir(localtarget):
+                    localtarget = os.path.join(localtarget, os.path.basename(remotefile))
+                if mode and subprocess.call(['chmod', mode, localtarget]):
+                    raise SSHError("change mode: %s" % localtarget)
+                if owner and subprocess.call(['chown', owner, localtarget]):
+                    raise SSHError("change owner: %s" % localtarget)
+
+    def communicate(self, pipe, command, input=None):
+        """
+        Send input to the ssh or scp process, wait for it to finish and
+        return its (stdout, stderr) tuple.
+
+        Internal function
+
+        :raise: SSHError, if the process has not finished within the timeout
+        """
+        try:
+            return pipe.communicate(input, timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            _terminate(pipe)
+            pipe.communicate()
+            raise SSHError("%s (under %s): SSH connect timeout" % (
+                ' '.join(u_list(command)), self.user))
 
     def convert_files_to_filenames(self, files):
         """
@@ -538,12 +671,13 @@ class SSHConnection(object):
                     basename = os.path.basename(file_obj.name)
                     tmpname = os.path.join(tmpdir, basename)
                     fd = io.open(tmpname, 'wb')
-                    fd.write(b(file_obj.read()))
-                    fd.close()
                 else:
                     tmpfd, tmpname = tempfile.mkstemp(dir=tmpdir)
-                    os.write(tmpfd, b(file_obj.read()))
-                    os.close(tmpfd)
+                    fd = io.open(tmpfd, 'wb')
+                try:
+                    _copy_file_obj(file_obj, fd)
+                finally:
+                    fd.close()
                 filenames.append(tmpname)
         return filenames, tmpdir
 
@@ -551,11 +685,12 @@ class SSHConnection(object):
         """
         Given a list of filenames and a target name return the full list of targets
 
+        .. deprecated:: scp() no longer needs a separate round-trip to find
+           out the targets, see :func:`scp_targets_command()`.
+
         :param filenames: list of filenames to copy (basenames)
         :param target: target file or directory
 
-        Internal command which is used to perform chmod and chown.
-
         Example::
 
             >>> ssh_connection.get_scp_targets(['foo.txt', 'bar.txt'], '/etc')
@@ -564,16 +699,41 @@ class SSHConnection(object):
             >>> get_scp_targets(['foo.txt', ], '/etc/passwd')
             ['/etc/passwd']
         """
-        result = self.run(b('test -d %s' % pipes.quote(u(target))))
-        is_directory = result.returncode == 0
-        if is_directory:
-            ret = []
-            for filename in filenames:
-                ret.append(os.path.join(target, os.path.basename(filename)))
-            return ret
+        warnings.warn('get_scp_targets() is deprecated, use scp_targets_command()',
+                      DeprecationWarning, stacklevel=2)
+        result = self.run(b_quote(['test', '-d', target]))
+        if result.returncode == 0:
+            return [os.path.join(target, os.path.basename(filename))
+                    for filename in filenames]
         else:
             return [target, ]
 
+    def scp_targets_command(self, commands, filenames, target):
+        """
+        Build a remote shell command which applies commands (like
+        ``[['chmod', '0644'], ['chown', 'nobody']]``) one after another to the
+        files copied by scp.
+
+        If target turns out to be a directory, the commands are applied to the
+        files inside it, otherwise to the target itself. The check is done by
+        the remote shell, which saves a separate round-trip to the server.
+
+        Internal command which is used to perform chmod and chown.
+
+        Example::
+
+            >>> ssh_connection.scp_targets_command([['chmod', '0644']], ['foo.txt', 'bar.txt'], '/etc')
+            b't=/etc; if [ -d "$t" ]; then chmod 0644 "$t"/foo.txt "$t"/bar.txt; else chmod 0644 "$t"; fi'
+        """
+        targets = b' '.join([b'"$t"/' + _quote_one(b(os.path.basename(filename)))
+                             for filename in filenames])
+        in_dir = b' && '.join([b_quote(cmd_chunks) + b' ' + targets
+                               for cmd_chunks in commands])
+        on_target = b' && '.join([b_quote(cmd_chunks) + b' "$t"'
+                                  for cmd_chunks in commands])
+        return b't=%s; if [ -d "$t" ]; then %s; else %s; fi' % (
+            b_quote([target]), in_dir, on_target)
+
     def ssh_command(self, interpreter=None,
                           forward_ssh_agent=False,
                           init_master=False,
@@ -590,37 +750,29 @@ class SSHConnection(object):
            :
             raise SSHError('SSHConnection.ssh_command(): No interpreter given.')
 
-        cmd = ['/usr/bin/ssh', ]
-        if self.debug:
-            cmd += ['-vvvv']
-        if self.login:
-            cmd += ['-l', self.login]
-        if self.configfile:
-            cmd += ['-F', self.configfile]
-        if self.identity_file:
-            cmd += ['-i', self.identity_file]
+        cmd = list(self._ssh_prefix)
         if forward_ssh_agent:
-            cmd.append('-A')
-        if self.port:
-            cmd += ['-p', str(self.port)]
+            cmd.append(b'-A')
         if interpreter == None:
-            cmd += ['-N']
+            cmd.append(b'-N')
         if self.master and init_master and self.control_path is not None:
-            cmd += ['-M', '-S', self.control_path]
+            cmd += [b'-M', b'-S', b(self.control_path)]
         if self.slave and self.control_path is not None and not init_master:
-            cmd += ['-S', self.control_path]
-        for tunnel in tunnels:
-            cmd += [ str(tunnel) ]
-        for option in self.options:
-            cmd += ['-o', option]
-
-        cmd.append(self.server)
+            cmd += [b'-S', b(self.control_path)]
+        if tunnels:
+            for tunnel in tunnels:
+                cmd.append(bytes(tunnel))
+            # a tunnel must not end up in a (backgrounded) shared master,
+            # or the process returned by run_tunnels() would not control it
+            cmd += self._ssh_options
+            cmd.append(b(self.server))
+        else:
+            cmd += self._ssh_suffix
 
         if interpreter:
-            interpreter = b(interpreter)
-            cmd.append(interpreter)
+            cmd.append(b(interpreter))
 
-        return b_list(cmd)
+        return cmd
 
     def scp_down_command(self, remotefile, localtarget):
         """
@@ -629,21 +781,10 @@ class SSHConnection(object):
         Include target(s) if specified. Internal function
         """
         if remotefile and localtarget:
-            cmd = ['/usr/bin/scp', self.debug and '-vvvv' or '-q', '-r']
-            if self.login:
-                remotename = '%s@%s' % (u(self.login), u(self.server))
-            else:
-                remotename = self.server
-            if self.configfile:
-                cmd += ['-F', self.configfile]
-            if self.identity_file:
-                cmd += ['-i', self.identity_file]
-            if self.port:
-                cmd += ['-P', self.port]
-            cmd.append('%s:%s' % (remotename, remotefile))
-            cmd.append(localtarget)
-
-            return b_list(cmd)
+            cmd = list(self._scp_prefix)
+            cmd.append(self.remote_name() + b':' + b(remotefile))
+            cmd.append(b(localtarget))
+            return cmd
         return None
 
     def scp_command(self, files, target):
@@ -652,59 +793,194 @@ class SSHConnection(object):
 
         Include target(s) if specified. Internal function
         """
-        cmd = ['/usr/bin/scp', self.debug and '-vvvv' or '-q', '-r']
-        files = b_list(files)
-        if self.login:
-            remotename = '%s@%s' % (u(self.login), u(self.server))
-        else:
-            remotename = self.server
-        if self.configfile:
-            cmd += ['-F', self.configfile]
-        if self.identity_file:
-            cmd += ['-i', self.identity_file]
-        if self.port:
-            cmd += ['-P', str(self.port)]
-        for option in self.options:
-            cmd += ['-o', option]
-
         if isinstance(files, (text, bytes)):
             raise ValueError('"files" argument have to be iterable (list or tuple)')
         if len(files) < 1:
             raise ValueError('You should name at least one file to copy')
 
-        cmd += files
-        cmd.append('%s:%s' % (remotename, target))
-        return b_list(cmd)
+        cmd = list(self._scp_prefix)
+        cmd += [b(filename) for filename in files]
+        cmd.append(self.remote_name() + b':' + b(target))
+        return cmd
+
+    def prepare_commands(self):
+        """
+        Build the parts of the ssh and scp command lines which don't change
+        between calls, so that ssh_command() and scp_command() only have to
+        add the per-call arguments.
+
+        Internal function
+        """
+        common = []
+        if self.configfile:
+            common += [b'-F', b(self.configfile)]
+        if self.identity_file:
+            common += [b'-i', b(self.identity_file)]
+        options = [arg for option in self.options for arg in (b'-o', b(option))]
+        multiplex_options = self.multiplex_options()
+
+        ssh_prefix = [b'/usr/bin/ssh']
+        if self.debug:
+            ssh_prefix.append(b'-vvvv')
+        if self.login:
+            ssh_prefix += [b'-l', self.login]
+        ssh_prefix += common
+        if self.port:
+            ssh_prefix += [b'-p', b(text(self.port))]
+        self._ssh_prefix = ssh_prefix
+        self._ssh_options = options
+        self._ssh_suffix = options + multiplex_options + [b(self.server)]
+
+        scp_prefix = [b'/usr/bin/scp', self.debug and b'-vvvv' or b'-q', b'-r']
+        scp_prefix += common
+        if self.port:
+            scp_prefix += [b'-P', b(text(self.port))]
+        if self.slave:
+            # scp has no -S option of its own, the control path is passed to ssh
+            scp_prefix += [b'-o', b'ControlPath=' + b(self.control_path)]
+        self._scp_prefix = scp_prefix + options + multiplex_options
+
+    def remote_name(self):
+        """
+        Build the "login@server" (or just "server") prefix of scp remote paths.
+
+        Internal function
+        """
+        if self.login:
+            return self.login + b'@' + b(self.server)
+        return b(self.server)
+
+    def multiplex_options(self):
+        """
+        Build the list of options which make ssh and scp share one connection.
+
+        Internal function
+        """
+        if not self.multiplex:
+            return []
+        return [b'-o', b'ControlMaster=auto',
+                b'-o', b'ControlPath=' + b(self.control_path),
+                b'-o', b'ControlPersist=' + b(CONTROL_PERSIST)]
+
+    def control_command(self, operation):
+        """
+        Build the command string to send a control request (like "check" or
+        "exit") to the shared connection.
+
+        Internal function
+        """
+        cmd = [b'/usr/bin/ssh', b'-O', b(operation)]
+        if self.login:
+            cmd += [b'-l', self.login]
+        if self.configfile:
+            cmd += [b'-F', b(self.configfile)]
+        if self.port:
+            cmd += [b'-p', b(text(self.port))]
+        cmd += [b'-o', b'ControlPath=' + b(self.control_path)]
+        cmd.append(b(self.server))
+        return cmd
 
     def get_env(self):
         """
         Retrieve environment variables and replace SSH_AUTH_SOCK
         if ssh_agent_socket was specified on object creation.
+
+        The environment is captured once, when the object is created; a copy
+        of it is returned.
         """
-        env = os.environ.copy()
-        if self.ssh_agent_socket:
-            env['SSH_AUTH_SOCK'] = self.ssh_agent_socket
-        return env
+        return dict(self._env)
 
 
-def _timeout_handler(signum, frame):
-    """ This function is called when ssh takes too long to connect. """
-    raise IOError('SSH connect timeout')
+def _send_file(file_obj, fd):
+    """
+    Copy a regular binary file to the binary file fd using os.sendfile,
+    so that the data does not pass through Python buffers at all.
+
+    Return False if file_obj is not suitable for that (or the platform
+    doesn't support sendfile between files), and nothing has been copied.
+    """
+    # tempfile.NamedTemporaryFile() and friends wrap the real file object
+    file_obj = getattr(file_obj, 'file', file_obj)
+    if not hasattr(os, 'sendfile') or \
+       not isinstance(file_obj, (io.BufferedIOBase, io.RawIOBase)):
+        return False
+    try:
+        in_fd = file_obj.fileno()
+    except io.UnsupportedOperation:  # in-memory streams like BytesIO
+        return False
+    in_stat = os.fstat(in_fd)
+    if not stat.S_ISREG(in_stat.st_mode):
+        return False
+    size = in_stat.st_size
+    start = offset = file_obj.tell()
+    fd.flush()
+    out_fd = fd.fileno()
+    try:
+        while offset < size:
+            sent = os.sendfile(out_fd, in_fd, offset, size - offset)
+            if not sent:
+                break
+            offset += sent
+    except OSError:
+        if offset == start:
+            return False
+        raise
+    # leave file_obj at the end of the data, as read() would do
+    file_obj.seek(offset)
+    return True
+
+
+def _copy_file_obj(file_obj, fd):
+    """
+    Copy the contents of a file-like object (binary or textual) to the
+    binary file fd chunk by chunk, without reading it into memory at once.
+    """
+    if _send_file(file_obj, fd):
+        return
+    while True:
+        chunk = file_obj.read(COPY_BUFSIZE)
+        if not chunk:
+            break
+        fd.write(b(chunk))
+
+
+def _terminate(pipe, timeout=1):
+    """
+    Ask the process to terminate, kill it if it doesn't exit within timeout
+    seconds, and reap it so that no zombie is left behind.
+    """
+    pipe.terminate()
+    try:
+        pipe.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        pipe.kill()
+        pipe.wait()
+
+
+_CURRENT_USER = None
+
+
+def _current_user():
+    """ Name of the local user, looked up once per process. """
+    global _CURRENT_USER
+    if _CURRENT_USER is None:
+        _CURRENT_USER = getpass.getuser()
+    return _CURRENT_USER
 
 
 class SSHResult(object):
     """
     Command execution status.
+
+    Attributes:
+
+    - command: command which has been executed remotely
+    - stdout: command execution stdout (no charset applied, binary object)
+    - stderr: command execution stderr (no charset applied, binary object)
+    - returncode: command return code (integer, 0 means "success" usually)
     """
-    #: command which has been executed remotely
-    command = None
-    #: command execution stdout (no charset applied, binary object)
-    stdout = None
-    #: command execution stderr (no charset applied, binary object)
-    stderr = None
-    #: command return code (integer, 0 means "success" usually)
-    returncode = None
 
+    __slots__ = ('command', 'stdout', 'stderr', 'returncode', '__weakref__')
 
     def __init__(self, command, stdout, stderr, returncode):
         """ Create a new object to hold output and a return code
@@ -720,36 +996,21 @@ class SSHResult(object):
 
         Effectively, returns stdout
         """
-        if sys.version[0] == '2':
-            # get ASCII representation.
-            return self.stdout
-        else:
-            # get string representation
-            return self.stdout.decode('utf-8', 'ignore')
+        return self.stdout.decode('utf-8', 'ignore')
 
     def __repr__(self):
         """
-        Get the verbose interpretation of the object
-
-        For python2.x it's the raw string objects, whereas python3.x
-        contains the unicode representation (str)
+        Get the verbose interpretation of the object (unicode representation)
         """
-        if sys.version[0] == '2':
-            # get ASCII representation.
-            return self.repr_binary()
-        else:
-            # get string representation
-            return self.repr_text()
+        return self.repr_text()
 
     def repr_binary(self):
         """ Build simple unicode representation from all member values. """
-        ret = []
-
-        ret += [b('command: '), b(self.command), b('\n')]
-        ret += [b('stdout: '), b(self.stdout), b('\n')]
-        ret += [b('stderr: '), b(self.stderr), b('\n')]
-        ret += [b('returncode: '), b(text(self.returncode))]
-        return b('').join(ret)
+        return b''.join((
+            b'command: ', b(self.command), b'\n',
+            b'stdout: ', b(self.stdout), b'\n',
+            b'stderr: ', b(self.stderr), b'\n',
+            b'returncode: ', b(text(self.returncode))))
 
     def repr_text(self):
         return self.repr_binary().decode('utf-8', 'ignore')
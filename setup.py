@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 import os
-from distutils.core import setup
+from setuptools import setup
 
 def read(fname):
     try:
@@ -18,13 +18,12 @@ setup(
     long_description = read('README.rst'),
     license = 'BSD License',
     py_modules=['openssh_wrapper'],
-    classifiers=(
+    python_requires='>=3.5',
+    classifiers=[
         'Development Status :: 5 - Beta',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: BSD License',
         'Topic :: Software Development :: Libraries :: Python Modules',
-        'Programming Language :: Python :: 2.6',
-        'Programming Language :: Python :: 2.7',
-        'Programming Language :: Python :: 3.3',
-    ),
+        'Programming Language :: Python :: 3',
+    ],
 )
@@ -1,63 +1,366 @@
 # -*- coding: utf-8 -*-
 import io
 import os
+import time
+import shutil
+import weakref
 import pytest
+import getpass
 import tempfile
+import functools
+import subprocess
 from openssh_wrapper import *
-
-test_file = os.path.join(os.path.dirname(__file__), 'tests.py')
+from openssh_wrapper import COPY_BUFSIZE
 
 
 def eq_(arg1, arg2):
     assert arg1 == arg2
 
-import getpass
-current_user=getpass.getuser()
+
+_PAYLOAD = b('test')
+
+
+@functools.lru_cache(maxsize=1)
+def _current_user():
+    return getpass.getuser()
+
+
+@functools.lru_cache(maxsize=1)
+def _test_file():
+    return os.path.join(os.path.dirname(__file__), 'tests.py')
+
+
+@functools.lru_cache(maxsize=1)
+def _target_dir():
+    # separate upload directory for every pytest-xdist worker
+    worker = os.environ.get('PYTEST_XDIST_WORKER', 'main')
+    return '/tmp/openssh-wrapper-tests-%s' % worker
+
+
+def _wait_for_master(master, timeout=5):
+    """
+    Give a master connection the chance to come up (i.e. create its control
+    socket) before it is used; otherwise slaves silently connect directly.
+    """
+    for _ in range(int(timeout / 0.1)):
+        if os.path.exists(master.control_path) or master.master_ssh_pipe.poll() is not None:
+            break
+        time.sleep(0.1)
+
+
+@pytest.fixture(scope='session')
+def shared_master():
+    """
+    Start one SSH master connection for the whole test session and return
+    its control path, so that tests don't go through the handshake and
+    authentication each time they talk to the server.
+
+    With pytest-xdist every worker runs a session, and so a master, of its own.
+    """
+    control_path_dir = tempfile.mkdtemp()
+    control_path = os.path.join(control_path_dir, 'control_path.socket')
+    master = SSHConnection('localhost', login=_current_user(),
+                           master=True, control_path=control_path,
+                           configfile='ssh_config.test')
+    _wait_for_master(master)
+    yield control_path
+    subprocess.call(['/usr/bin/ssh', '-O', 'stop', '-S', control_path, 'localhost'],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    master.close()
+    shutil.rmtree(control_path_dir, ignore_errors=True)
+
+
+@pytest.fixture
+def shared_slave(shared_master):
+    """ Connection which runs commands through the shared master. """
+    with SSHConnection('localhost', slave=True, control_path=shared_master,
+                       configfile='ssh_config.test') as c:
+        yield c
+
 
 class TestSSHCommandNames(object):
 
+    @classmethod
+    def setup_class(cls):
+        # expected command lines are built once for the whole class
+        user = _current_user()
+        cls.expect_ssh_cmd = b_list(['/usr/bin/ssh', '-l', user, '-F', 'ssh_config.test',
+                                     'localhost', '/bin/bash'])
+        cls.expect_scp_cmd = b_list(['/usr/bin/scp', '-q', '-r', '-F', 'ssh_config.test',
+                                     '/tmp/1.txt', '%s@localhost:/tmp/2.txt' % user])
+        cls.expect_scp_multiple_cmd = b_list(['/usr/bin/scp', '-q', '-r', '-F', 'ssh_config.test',
+                                              '/tmp/1.txt', '2.txt', '%s@localhost:/home/username/' % user])
+
     def setup_method(self, meth):
-        self.c = SSHConnection('localhost', login=current_user,
-                               configfile='ssh_config.test')
+        self.c = SSHConnection('localhost', login=_current_user(),
+                               configfile='ssh_config.test', multiplex=False)
 
     def test_ssh_command(self):
-        eq_(self.c.ssh_command('/bin/bash', False),
-            b_list(['/usr/bin/ssh', '-l', current_user, '-F', 'ssh_config.test', 'localhost', '/bin/bash']))
+        eq_(self.c.ssh_command('/bin/bash', False), self.expect_ssh_cmd)
+
+    def test_tunnels_ssh_command(self):
+        tunnels = [SSHForwardingTunnel(local_port=8080, remote_port=80),
+                   SSHRevForwardingTunnel('0.0.0.0', 2222, 'localhost', 22)]
+        eq_(self.c.ssh_command(tunnels=tunnels),
+            b_list(['/usr/bin/ssh', '-l', _current_user(), '-F', 'ssh_config.test', '-N',
+                    '-L localhost:8080:localhost:80', '-R 0.0.0.0:2222:localhost:22', 'localhost']))
 
     def test_scp_command(self):
-        eq_(self.c.scp_command(('/tmp/1.txt', ), target='/tmp/2.txt'),
-            b_list(['/usr/bin/scp', '-q', '-r', '-F', 'ssh_config.test', '/tmp/1.txt', '{user}@localhost:/tmp/2.txt'.format(user=current_user)]))
+        eq_(self.c.scp_command(('/tmp/1.txt', ), target='/tmp/2.txt'), self.expect_scp_cmd)
 
     def test_scp_multiple_files(self):
         eq_(self.c.scp_command(('/tmp/1.txt', '2.txt'), target='/home/username/'),
-            b_list(['/usr/bin/scp', '-q', '-r', '-F', 'ssh_config.test', '/tmp/1.txt', '2.txt',
-                    '{user}@localhost:/home/username/'.format(user=current_user)]))
-
-    def test_scp_targets(self):
-        targets = self.c.get_scp_targets(['foo.txt', 'bar.txt'], '/etc')
-        eq_(targets, ['/etc/foo.txt', '/etc/bar.txt'])
-        targets = self.c.get_scp_targets(['foo.txt'], '/etc/passwd')
-        eq_(targets, ['/etc/passwd'])
-
-    def test_simple_command(self):
-        result = self.c.run('whoami')
-        eq_(result.stdout, b(current_user))
+            self.expect_scp_multiple_cmd)
+
+    def test_multiplex_ssh_command(self):
+        c = SSHConnection('localhost', login=_current_user(),
+                          configfile='ssh_config.test')
+        eq_(c.ssh_command('/bin/bash', False),
+            b_list(['/usr/bin/ssh', '-l', _current_user(), '-F', 'ssh_config.test',
+                    '-o', 'ControlMaster=auto', '-o', 'ControlPath=%s' % c.control_path,
+                    '-o', 'ControlPersist=60s', 'localhost', '/bin/bash']))
+        # tunnels are not run through the shared connection
+        eq_(c.ssh_command(tunnels=[SSHForwardingTunnel(local_port=8080, remote_port=80)]),
+            b_list(['/usr/bin/ssh', '-l', _current_user(), '-F', 'ssh_config.test', '-N',
+                    '-L localhost:8080:localhost:80', 'localhost']))
+        control_dir = os.path.dirname(c.control_path)
+        assert os.path.isdir(control_dir)
+        # ssh refuses control paths longer than the unix socket limit (104 bytes on macOS)
+        assert len(c.control_path) < 104
+        c.close()
+        assert not os.path.exists(control_dir)
+
+    def test_debug_ssh_command(self):
+        # no automatic connection sharing in debug mode
+        c = SSHConnection('localhost', login=_current_user(),
+                          configfile='ssh_config.test', debug=True)
+        eq_(c.ssh_command('/bin/bash', False),
+            b_list(['/usr/bin/ssh', '-vvvv', '-l', _current_user(), '-F', 'ssh_config.test',
+                    'localhost', '/bin/bash']))
+        eq_(c.scp_command(('/tmp/1.txt', ), target='/tmp/2.txt'),
+            b_list(['/usr/bin/scp', '-vvvv', '-r', '-F', 'ssh_config.test', '/tmp/1.txt',
+                    '%s@localhost:/tmp/2.txt' % _current_user()]))
+        c.close()
+
+    def test_scp_targets_command(self):
+        eq_(self.c.scp_targets_command([['chmod', '0644']], ['/tmp/foo.txt', 'bar baz.txt'], '/etc'),
+            b('t=/etc; if [ -d "$t" ]; then chmod 0644 "$t"/foo.txt "$t"/\'bar baz.txt\'; '
+              'else chmod 0644 "$t"; fi'))
+        eq_(self.c.scp_targets_command([['chmod', '0644'], ['chown', 'nobody:']], ['foo.txt'], '/etc'),
+            b('t=/etc; if [ -d "$t" ]; then chmod 0644 "$t"/foo.txt && chown nobody: "$t"/foo.txt; '
+              'else chmod 0644 "$t" && chown nobody: "$t"; fi'))
+
+    def test_simple_command(self, shared_slave):
+        result = shared_slave.run('whoami')
+        eq_(result.stdout, b(_current_user()))
         eq_(result.stderr, b(''))
         eq_(result.returncode, 0)
 
-    def test_python_command(self):
-        result = self.c.run('print "Hello world"', interpreter='/usr/bin/python')
+    def test_run_many(self, shared_slave):
+        results = shared_slave.run_many(['whoami', 'echo foo', 'exit 3'])
+        eq_([result.stdout for result in results], [b(_current_user()), b('foo'), b('')])
+        eq_([result.returncode for result in results], [0, 0, 3])
+
+    def test_python_command(self, shared_slave):
+        result = shared_slave.run('print "Hello world"', interpreter='/usr/bin/python')
         eq_(result.stdout, b('Hello world'))
         eq_(result.stderr, b(''))
         eq_(result.returncode, 0)
 
 
-def test_timeout():
-    c = SSHConnection('example.com', login=current_user, timeout=1)
+class _FakePopen(object):
+    """ Stands for an ssh process which fails to connect to the server. """
+
+    returncode = 255
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def communicate(self, input=None, timeout=None):
+        return b(''), b('ssh: connect to host example.com port 22: Connection timed out')
+
+
+class _HangingPopen(object):
+    """ Stands for an ssh process which doesn't finish in time. """
+
+    returncode = None
+
+    def __init__(self, *args, **kwargs):
+        self.calls = []
+        _HangingPopen.last = self
+
+    def communicate(self, input=None, timeout=None):
+        if not self.calls:
+            raise subprocess.TimeoutExpired('ssh', timeout)
+        return b(''), b('')
+
+    def terminate(self):
+        self.calls.append('terminate')
+
+    def wait(self, timeout=None):
+        self.calls.append('wait')
+        self.returncode = -15
+        return self.returncode
+
+    def kill(self):
+        self.calls.append('kill')
+
+
+class _StubbornPopen(_HangingPopen):
+    """ Stands for an ssh process which also ignores SIGTERM. """
+
+    def wait(self, timeout=None):
+        _HangingPopen.wait(self, timeout)
+        if timeout is not None and 'kill' not in self.calls:
+            raise subprocess.TimeoutExpired('ssh', timeout)
+        return self.returncode
+
+
+class _ScpDownPopen(subprocess.Popen):
+    """ Stands for scp downloading a file, runs any other command for real. """
+
+    def __init__(self, args, *pargs, **kwargs):
+        if args[0] != b('/usr/bin/scp'):
+            super().__init__(args, *pargs, **kwargs)
+            return
+        localtarget = args[-1]
+        if os.path.isdir(localtarget):
+            localtarget = os.path.join(localtarget, os.path.basename(args[-2].split(b(':'))[-1]))
+        io.open(localtarget, 'wb').close()
+        os.chmod(localtarget, 0o644)
+        self.returncode = 0
+
+    def communicate(self, input=None, timeout=None):
+        return b(''), b('')
+
+
+def test_close_keeps_original_error(monkeypatch):
+    c = SSHConnection('localhost', login=_current_user(), timeout=1)
+    control_dir = os.path.dirname(c.control_path)
+    io.open(c.control_path, 'wb').close()  # pretend the master is running
+    monkeypatch.setattr('openssh_wrapper.subprocess.Popen', _HangingPopen)
+    with pytest.raises(ValueError):
+        with c:
+            raise ValueError()
+    assert not os.path.exists(control_dir)
+
+
+def test_communicate_timeout(monkeypatch):
+    monkeypatch.setattr('openssh_wrapper.subprocess.Popen', _HangingPopen)
+    c = SSHConnection('localhost', login=_current_user(), timeout=1, multiplex=False)
+    with pytest.raises(SSHError) as exc:
+        c.run('whoami')
+    assert 'SSH connect timeout' in str(exc.value)
+    # terminated, reaped and drained
+    eq_(_HangingPopen.last.calls, ['terminate', 'wait'])
+
+
+def test_communicate_timeout_kill(monkeypatch):
+    monkeypatch.setattr('openssh_wrapper.subprocess.Popen', _StubbornPopen)
+    c = SSHConnection('localhost', login=_current_user(), timeout=1, multiplex=False)
+    with pytest.raises(SSHError):
+        c.run('whoami')
+    eq_(_HangingPopen.last.calls, ['terminate', 'wait', 'kill', 'wait'])
+
+
+def test_timeout(monkeypatch):
+    monkeypatch.setattr('openssh_wrapper.subprocess.Popen', _FakePopen)
+    c = SSHConnection('example.com', login=_current_user(), timeout=1)
     with pytest.raises(SSHError):  # ssh connect timeout
         c.run('whoami')
 
 
+@pytest.mark.network
+def test_timeout_network():
+    c = SSHConnection('example.com', login=_current_user(), timeout=1)
+    with pytest.raises(SSHError):  # ssh connect timeout
+        c.run('whoami')
+
+
+def test_b_quote():
+    eq_(b_quote(['chmod', '0644', '/tmp/foo.txt']), b('chmod 0644 /tmp/foo.txt'))
+    eq_(b_quote([b('a b'), "it's", '']), b('\'a b\' \'it\'"\'"\'s\' \'\''))
+
+
+def test_result_repr():
+    eq_(repr(SSHResult('whoami', b('root'), b(''), 0)),
+        'command: whoami\nstdout: root\nstderr: \nreturncode: 0')
+    assert repr(SSHResult('whoami', b(''), b(''), None)).endswith('returncode: None')
+
+
+def test_scp_down_mode(monkeypatch, tmp_path):
+    monkeypatch.setattr('openssh_wrapper.subprocess.Popen', _ScpDownPopen)
+    c = SSHConnection('localhost', login=_current_user(), multiplex=False)
+    c.scp_down('/tmp/remote.txt', str(tmp_path / 'local.txt'), mode='0600')
+    eq_(os.stat(str(tmp_path / 'local.txt')).st_mode & 0o777, 0o600)
+    # the mode of a file downloaded into a directory is set as well
+    c.scp_down('/tmp/remote.txt', str(tmp_path), mode='0640')
+    eq_(os.stat(str(tmp_path / 'remote.txt')).st_mode & 0o777, 0o640)
+
+
+def test_get_scp_targets_deprecated(monkeypatch):
+    # "test -d" fails, so the target is not a directory
+    monkeypatch.setattr(SSHConnection, 'run',
+                        lambda self, command: SSHResult(command, b(''), b(''), 1))
+    c = SSHConnection('localhost', login=_current_user(), multiplex=False)
+    with pytest.warns(DeprecationWarning):
+        eq_(c.get_scp_targets(['foo.txt'], '/etc/passwd'), ['/etc/passwd'])
+
+
+def test_get_env():
+    c = SSHConnection('localhost', ssh_agent_socket='/tmp/agent.sock', multiplex=False)
+    env = c.get_env()
+    eq_(env['SSH_AUTH_SOCK'], '/tmp/agent.sock')
+    env['SSH_AUTH_SOCK'] = '/tmp/other.sock'
+    eq_(c.get_env()['SSH_AUTH_SOCK'], '/tmp/agent.sock')
+
+
+def test_weakref():
+    c = SSHConnection('localhost', multiplex=False)
+    assert weakref.ref(c)() is c
+    result = SSHResult('whoami', b(''), b(''), 0)
+    assert weakref.ref(result)() is result
+
+
+def test_illegal_server_name():
+    for server in ('local host', 'localhost\n', ''):
+        with pytest.raises(SSHError):
+            SSHConnection(server, multiplex=False)
+
+
+def test_context_manager():
+    with SSHConnection('localhost', login=_current_user()) as c:
+        control_dir = os.path.dirname(c.control_path)
+        assert os.path.isdir(control_dir)
+    assert not os.path.exists(control_dir)
+
+
+def test_multiplex_control_path(monkeypatch, tmp_path):
+    with pytest.raises(SSHError):
+        SSHConnection('localhost', control_path=str(tmp_path / 'missing' / 'control'))
+    control_path = str(tmp_path / 'control')
+    c = SSHConnection('localhost', login=_current_user(), control_path=control_path)
+    io.open(control_path, 'wb').close()  # pretend the master is running
+    monkeypatch.setattr('openssh_wrapper.subprocess.Popen', _HangingPopen)
+    _HangingPopen.last = None
+    c.close()
+    # the master is asked to exit, but the caller's directory is left alone
+    assert _HangingPopen.last is not None
+    assert os.path.isdir(str(tmp_path))
+
+
+def test_multiplex_run():
+    c = SSHConnection('localhost', login=_current_user(), configfile='ssh_config.test')
+    with c:
+        eq_(c.run('whoami').stdout, b(_current_user()))
+        assert os.path.exists(c.control_path)
+        eq_(c.run('echo foo').stdout, b('foo'))
+        check_command = c.control_command('check')
+    # the master has gone together with its control socket
+    assert subprocess.call(check_command, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL) != 0
+
+
 def test_permission_denied():
     c = SSHConnection('localhost', login='www-data', configfile='ssh_config.test')
     with pytest.raises(SSHError):  # Permission denied (publickey)
@@ -66,84 +369,177 @@ def test_permission_denied():
 
 class TestSCP(object):
 
-    def setup_method(self, meth):
-        self.c = SSHConnection('localhost', login=current_user)
-        self.c.run('rm -f /tmp/*.py /tmp/test*.txt')
-
-    def test_scp(self):
-        self.c.scp((test_file, ), target='/tmp')
-        assert os.path.isfile('/tmp/tests.py')
-
-    def test_scp_int_port(self):
-        c = SSHConnection('localhost', login=current_user, port=22)
-        c.scp((test_file, ), target='/tmp')
-        assert os.path.isfile('/tmp/tests.py')
-
-    def test_scp_str_port(self):
-        c = SSHConnection('localhost', login=current_user, port='22')
-        c.scp((test_file, ), target='/tmp')
-        assert os.path.isfile('/tmp/tests.py')
+    @pytest.fixture(autouse=True)
+    def setup_connection(self, shared_slave):
+        self.c = shared_slave
+        self.target = _target_dir()
+        self.c.run(b_quote(['mkdir', '-p', self.target]) + b(' && ') +
+                   b_quote(['find', self.target, '-mindepth', '1', '-delete']))
+
+    def test_scp_batch(self, tmp_path):
+        # several files (and the mode change for all of them) in one go
+        names = ['tests.py', 'tests_copy2.py', 'tests_copy3.py']
+        sources = [_test_file()]
+        for name in names[1:]:
+            os.symlink(os.path.abspath(_test_file()), str(tmp_path / name))
+            sources.append(str(tmp_path / name))
+        self.c.scp(sources, target=self.target, mode='0666')
+        for name in names:
+            mode = os.stat(os.path.join(self.target, name)).st_mode & 0o777
+            eq_(mode, 0o666)
+
+    @pytest.mark.parametrize('port', [22, '22'], ids=['int', 'str'])
+    def test_scp_port(self, port, shared_master):
+        with SSHConnection('localhost', port=port, slave=True,
+                           control_path=shared_master, configfile='ssh_config.test') as c:
+            c.scp((_test_file(), ), target=self.target)
+        assert os.path.isfile(os.path.join(self.target, 'tests.py'))
 
     def test_scp_to_nonexistent_dir(self):
         with pytest.raises(SSHError):
-            self.c.scp((test_file, ), target='/abc/def/')
-
-    def test_mode(self):
-        self.c.scp((test_file, ), target='/tmp', mode='0666')
-        mode = os.stat('/tmp/tests.py').st_mode & 0o777
-        eq_(mode, 0o666)
+            self.c.scp((_test_file(), ), target='/abc/def/')
 
     def test_owner(self):
         import pwd, grp
         uid, gid = os.getuid(), os.getgid()
         user, group = pwd.getpwuid(uid).pw_name, grp.getgrgid(gid).gr_name
-        self.c.scp((test_file, ), target='/tmp', owner='%s:%s' % (user, group))
-        stat = os.stat('/tmp/tests.py')
+        self.c.scp((_test_file(), ), target=self.target, owner='%s:%s' % (user, group))
+        stat = os.stat(os.path.join(self.target, 'tests.py'))
         eq_(stat.st_uid, uid)
         eq_(stat.st_gid, gid)
 
     def test_file_descriptors(self):
         # name is set explicitly as target
-        fd1 = io.BytesIO(b('test'))
-        self.c.scp((fd1, ), target='/tmp/test1.txt', mode='0644')
-        assert io.open('/tmp/test1.txt', 'rt').read() == 'test'
+        fd1 = io.BytesIO(_PAYLOAD)
+        target1 = os.path.join(self.target, 'test1.txt')
+        self.c.scp((fd1, ), target=target1, mode='0600')
+        assert io.open(target1, 'rb').read() == _PAYLOAD
+        eq_(os.stat(target1).st_mode & 0o777, 0o600)
+
+        # names are set explicitly in the name option, both files go in one scp call
+        fd2, fd3 = io.BytesIO(_PAYLOAD), io.BytesIO(_PAYLOAD)
+        fd2.name, fd3.name = 'test2.txt', 'test3.txt'
+        self.c.scp((fd2, fd3), target=self.target, mode='0644')
+        for name in ('test2.txt', 'test3.txt'):
+            assert io.open(os.path.join(self.target, name), 'rb').read() == _PAYLOAD
 
-        # name is set explicitly in the name option
-        fd2 = io.BytesIO(b('test'))
-        fd2.name = 'test2.txt'
-        self.c.scp((fd2, ), target='/tmp', mode='0644')
-        assert io.open('/tmp/test2.txt', 'rt').read() == 'test'
+
+class TestConvertFiles(object):
+
+    def setup_method(self, meth):
+        self.c = SSHConnection('localhost', multiplex=False)
+        self.tmpdir = None
+
+    def teardown_method(self, meth):
+        if self.tmpdir:
+            shutil.rmtree(self.tmpdir)
+
+    def convert(self, file_obj):
+        filenames, self.tmpdir = self.c.convert_files_to_filenames([file_obj])
+        return io.open(filenames[0], 'rb').read()
+
+    def test_regular_file(self, tmp_path, monkeypatch):
+        calls = []
+        def sendfile(*args, _sendfile=os.sendfile):
+            calls.append(args)
+            return _sendfile(*args)
+        monkeypatch.setattr('openssh_wrapper.os.sendfile', sendfile)
+        data = os.urandom(3 * 1024 * 1024)
+        (tmp_path / 'data.bin').write_bytes(data)
+        with io.open(str(tmp_path / 'data.bin'), 'rb') as fd:
+            fd.read(10)  # the buffer has read ahead of tell() here
+            eq_(self.convert(fd), data[10:])
+            eq_(fd.tell(), len(data))
+        assert calls
+
+    def test_named_temporary_file(self, monkeypatch):
+        calls = []
+        def sendfile(*args, _sendfile=os.sendfile):
+            calls.append(args)
+            return _sendfile(*args)
+        monkeypatch.setattr('openssh_wrapper.os.sendfile', sendfile)
+        with tempfile.NamedTemporaryFile() as fd:
+            fd.write(_PAYLOAD)
+            fd.seek(0)
+            eq_(self.convert(fd), _PAYLOAD)
+        assert calls
+
+    def test_regular_file_sendfile_failure(self, tmp_path, monkeypatch):
+        def sendfile(*args):
+            raise OSError('sendfile to a file is not supported')
+        monkeypatch.setattr('openssh_wrapper.os.sendfile', sendfile)
+        data = os.urandom(1024)
+        (tmp_path / 'data.bin').write_bytes(data)
+        with io.open(str(tmp_path / 'data.bin'), 'rb') as fd:
+            fd.read(10)
+            eq_(self.convert(fd), data[10:])
+
+    def test_text_stream(self):
+        # several chunks, with non-ASCII characters across chunk borders
+        data = u'тест' * (COPY_BUFSIZE // 2)
+        eq_(self.convert(io.StringIO(data)), data.encode('utf-8'))
+
+    def test_bytes_stream(self):
+        eq_(self.convert(io.BytesIO(_PAYLOAD)), _PAYLOAD)
 
 
 class TestSSHMasterSlaveConnections(object):
 
     def setup_method(self, meth):
-        control_path_dir = tempfile.mkdtemp()
-        self.control_path='{tmpdir}/control_path.socket'.format(tmpdir=control_path_dir)
-        self.c_ms = SSHConnection('localhost', login=current_user,
-                               master=True, slave=True, control_path=self.control_path,
-                               configfile='ssh_config.test')
-        self.c_m = SSHConnection('localhost', login=current_user,
-                               master=True, control_path=self.control_path,
-                               configfile='ssh_config.test')
-        self.c_s = SSHConnection('localhost', login=current_user,
-                               slave=True, control_path=self.control_path,
-                               configfile='ssh_config.test')
+        self._tmp = tempfile.TemporaryDirectory()
+        self.control_path='{tmpdir}/control_path.socket'.format(tmpdir=self._tmp.name)
+        self.expect_initmaster_cmd = b_list(['/usr/bin/ssh', '-l', _current_user(), '-F', 'ssh_config.test',
+                                             '-N', '-M', '-S', self.control_path, 'localhost'])
+        self.expect_slave_cmd = b_list(['/usr/bin/ssh', '-F', 'ssh_config.test',
+                                        '-S', self.control_path, 'localhost', '/bin/bash'])
+
+    def teardown_method(self, meth):
+        # release the control socket before its directory is removed
+        if os.path.exists(self.control_path):
+            try:
+                subprocess.run(['/usr/bin/ssh', '-O', 'stop', '-S', self.control_path, 'localhost'],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=2)
+            except Exception:
+                pass
+        # only the connections a test has actually used have been created
+        for name in ('c_ms', 'c_m', 'c_s'):
+            if name in self.__dict__:
+                self.__dict__[name].close()
+        self._tmp.cleanup()
+
+    # connections are created on first access, as every test needs only one
+    # or two of them (and creating a master connection starts ssh)
+
+    @functools.cached_property
+    def c_ms(self):
+        return SSHConnection('localhost', login=_current_user(),
+                             master=True, slave=True, control_path=self.control_path,
+                             configfile='ssh_config.test')
+
+    @functools.cached_property
+    def c_m(self):
+        return SSHConnection('localhost', login=_current_user(),
+                             master=True, control_path=self.control_path,
+                             configfile='ssh_config.test')
+
+    @functools.cached_property
+    def c_s(self):
+        return SSHConnection('localhost', login=_current_user(),
+                             slave=True, control_path=self.control_path,
+                             configfile='ssh_config.test')
 
     # MASTER+SLAVE MODE
     # one SSHConnection instance acts as master and slave connection
 
     def test_masterslave_initmaster_ssh_command(self):
-        eq_(self.c_m.ssh_command(init_master=True),
-            b_list(['/usr/bin/ssh', '-l', current_user, '-F', 'ssh_config.test', '-N', '-M', '-S', self.control_path, 'localhost']))
+        eq_(self.c_m.ssh_command(init_master=True), self.expect_initmaster_cmd)
 
     def test_masterslave_ssh_command(self):
-        eq_(self.c_ms.ssh_command('/bin/bash', False),
-            b_list(['/usr/bin/ssh', '-F', 'ssh_config.test', '-S', self.control_path, 'localhost', '/bin/bash']))
+        eq_(self.c_ms.ssh_command('/bin/bash', False), self.expect_slave_cmd)
 
     def test_masterslave_simple_command(self):
         result = self.c_ms.run('whoami')
-        eq_(result.stdout, b(current_user))
+        eq_(result.stdout, b(_current_user()))
         eq_(result.stderr, b(''))
         eq_(result.returncode, 0)
 
@@ -151,18 +547,23 @@ class TestSSHMasterSlaveConnections(object):
     # an SSHConnection instance is in master-only mode
 
     def test_master_initmaster_ssh_command(self):
-        eq_(self.c_m.ssh_command(init_master=True),
-            b_list(['/usr/bin/ssh', '-l', current_user, '-F', 'ssh_config.test', '-N', '-M', '-S', self.control_path, 'localhost']))
+        eq_(self.c_m.ssh_command(init_master=True), self.expect_initmaster_cmd)
 
     # SLAVE-ONLY MODE
     # another SSHConnection instance shared connections with another SSHConnection that runs in master+slave or master-only mode
 
     def test_slave_ssh_command(self):
-        eq_(self.c_s.ssh_command('/bin/bash', False),
-            b_list(['/usr/bin/ssh',  '-F', 'ssh_config.test', '-S', self.control_path, 'localhost', '/bin/bash']))
+        eq_(self.c_s.ssh_command('/bin/bash', False), self.expect_slave_cmd)
+
+    def test_slave_scp_command(self):
+        eq_(self.c_s.scp_command(('/tmp/1.txt', ), target='/tmp/2.txt'),
+            b_list(['/usr/bin/scp', '-q', '-r', '-F', 'ssh_config.test',
+                    '-o', 'ControlPath=%s' % self.control_path, '/tmp/1.txt', 'localhost:/tmp/2.txt']))
 
     def test_slave_simple_command(self):
+        _wait_for_master(self.c_m)
+        assert os.path.exists(self.control_path)
         result = self.c_s.run('whoami')
-        eq_(result.stdout, b(current_user))
+        eq_(result.stdout, b(_current_user()))
         eq_(result.stderr, b(''))
         eq_(result.returncode, 0)